@@ -1,40 +1,57 @@
 # backend_core/app_server.py
 
-import threading
+import asyncio
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Set
+from uuid import uuid4
 
-import torch
-from fastapi import FastAPI, UploadFile, File, Form
+import aiofiles
+from fastapi import BackgroundTasks, FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import (
     StreamingResponse,
     JSONResponse,
     HTMLResponse,
+    ORJSONResponse,
     Response,
 )
 from pydantic import BaseModel
-from transformers import TextIteratorStreamer
+from transformers import AsyncTextIteratorStreamer
 
-from model_loader import get_llm, get_llm_tokenizer, load_models
+from batch_scheduler import submit_extend, submit_generation
+from model_loader import get_llm_tokenizer, load_models
 from memory_handler import (
     add_message,
     format_history_for_prompt,
     clear_history,
     get_history,
+    get_job,
+    get_kv,
+    save_job,
+    set_kv,
 )
 from rag_engine import (
     add_document_from_file,
+    embed_query,
     query_corpus,
     corpus_size,
+    load_index,
+)
+import semantic_cache
+from utils_core import (
+    build_history_section,
+    build_history_turn,
+    build_turn_prompt,
+    sanitize_stream_text,
 )
-from utils_core import build_prompt, sanitize_stream_text
 
 BASE_DIR = Path(__file__).resolve().parent
 UPLOAD_DIR = BASE_DIR / "vector_store"
 UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
+UPLOAD_CHUNK_BYTES = 1 << 20
 
-app = FastAPI(title="Granite Advanced Chatbot")
+# orjson serializes plain dicts directly, skipping jsonable_encoder
+app = FastAPI(title="Granite Advanced Chatbot", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -71,6 +88,7 @@ def on_startup():
     print("[app_server] Starting up, loading models...")
     load_models()
     print("[app_server] Models ready.")
+    load_index()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -97,55 +115,141 @@ async def chat_stream(req: ChatRequest):
     if not user_message:
         return JSONResponse({"error": "Empty message"}, status_code=400)
 
-    def token_generator():
-        history_prompt = format_history_for_prompt(session_id)
-        rag_hits = query_corpus(user_message, top_k=4) if use_rag else []
-
-        prompt = build_prompt(
-            history_prompt=history_prompt,
-            user_message=user_message,
-            rag_context=rag_hits,
-            mode=mode,
+    # Async generator: StreamingResponse iterates it on the event loop
+    # instead of hopping through the threadpool for every chunk.
+    async def token_generator():
+        # Semantic cache: only for a session's first turn, since later
+        # answers depend on the conversation so far.
+        cache_key = f"{mode}:rag" if use_rag else mode
+        history = await get_history(session_id)
+        prompt_embedding = None
+        if not history:
+            prompt_embedding = await asyncio.to_thread(embed_query, user_message)
+            cached = semantic_cache.lookup(prompt_embedding, cache_key)
+            if cached is not None:
+                for start in range(0, len(cached), 32):
+                    yield sanitize_stream_text(cached[start:start + 32])
+                    await asyncio.sleep(0.01)
+                await add_message(session_id, "user", user_message)
+                await add_message(session_id, "assistant", cached)
+                # The session KV no longer matches the history
+                set_kv(session_id, mode, len(history) + 2, None)
+                return
+
+        rag_hits = (
+            await asyncio.to_thread(query_corpus, user_message, 4) if use_rag else []
         )
 
-        model = get_llm()
-        tokenizer = get_llm_tokenizer()
-        device = model.device if hasattr(model, "device") else torch.device("cpu")
-
-        inputs = tokenizer(prompt, return_tensors="pt").to(device)
-        streamer = TextIteratorStreamer(
-            tokenizer,
+        # The session KV covers prefix + history, so only this turn's text is
+        # prefilled; otherwise (new session, evicted or stale cache, mode
+        # switch) the history section is rebuilt from the stored text. Both
+        # paths give the same layout: prefix, history, RAG context, message.
+        session_kv = get_kv(session_id, mode, len(history))
+        context = ""
+        if session_kv is None:
+            context = build_history_section(format_history_for_prompt(history))
+        prompt = build_turn_prompt(user_message, rag_hits, after_history=bool(history))
+
+        # The batch scheduler only pushes generated tokens, never the prompt.
+        # The streamer hands decoded text to this loop via call_soon_threadsafe.
+        streamer = AsyncTextIteratorStreamer(
+            get_llm_tokenizer(),
             skip_special_tokens=True,
-            skip_prompt=True,
         )
-
-        generate_kwargs = dict(
-            **inputs,
+        # Only context + prompt are prefilled; the prefix KV is cached per mode
+        generation = submit_generation(
+            prompt,
+            streamer,
+            mode=mode,
+            context=context,
+            past_key_values=session_kv,
             max_new_tokens=400,
             temperature=0.3,
             top_p=0.9,
-            do_sample=True,
-            streamer=streamer,
         )
 
-        thread = threading.Thread(target=model.generate, kwargs=generate_kwargs)
-        thread.start()
-
         collected: List[str] = []
-        for new_text in streamer:
+        async for new_text in streamer:
             collected.append(new_text)
             yield sanitize_stream_text(new_text)
 
+        if generation.error is not None:
+            # Nothing is stored, so the turn can simply be retried
+            yield f"\n[Error] Generation failed: {generation.error}"
+            return
+
         full_answer = "".join(collected).strip()
         if full_answer:
-            add_message(session_id, "user", user_message)
-            add_message(session_id, "assistant", full_answer)
+            await add_message(session_id, "user", user_message)
+            await add_message(session_id, "assistant", full_answer)
+            # Extend the history cache with this turn's text only, so RAG
+            # snippets are not kept in the session KV
+            if generation.base_past is not None:
+                turn = build_history_turn(user_message, full_answer, first_turn=not history)
+                _spawn(_store_session_kv(
+                    session_id,
+                    mode,
+                    len(history) + 2,
+                    submit_extend(generation.base_past, turn),
+                ))
+            # Only cache answers that ended naturally, not truncated ones
+            if prompt_embedding is not None and generation.hit_eos:
+                semantic_cache.insert(prompt_embedding, cache_key, full_answer)
+        else:
+            set_kv(session_id, mode, len(history), None)
 
     return StreamingResponse(token_generator(), media_type="text/plain")
 
 
+# Strong references to fire-and-forget tasks until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _store_session_kv(session_id: str, mode: str, n_messages: int, future) -> None:
+    """
+    Wait for the scheduler to extend the session KV, then cache it unless
+    the session changed in the meantime (e.g. it was cleared).
+    """
+    try:
+        past = await asyncio.wrap_future(future)
+    except Exception:
+        return
+    if len(await get_history(session_id)) == n_messages:
+        set_kv(session_id, mode, n_messages, past)
+
+
+async def _run_ingest(job: Dict[str, Any], save_path: Path, source_name: str) -> None:
+    """
+    Background task: extract, chunk, embed and index an uploaded file.
+    """
+    job["status"] = "running"
+    await save_job(job)
+    try:
+        chunks_added = await asyncio.to_thread(
+            add_document_from_file, str(save_path), source_name=source_name
+        )
+        if chunks_added:
+            # Cached answers may not reflect the new document
+            semantic_cache.clear()
+        job.update(
+            status="ok",
+            chunks_added=chunks_added,
+            total_chunks=corpus_size(),
+        )
+    except Exception as e:
+        job.update(status="error", error=str(e))
+    await save_job(job)
+
+
 @app.post("/upload_file")
 async def upload_file(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     source_name: str = Form(None),
 ):
@@ -155,38 +259,49 @@ async def upload_file(
     if source_name is None or not source_name.strip():
         source_name = file.filename
 
-    save_path = UPLOAD_DIR / file.filename
-    with open(save_path, "wb") as f:
-        f.write(await file.read())
-
-    try:
-        chunks_added = add_document_from_file(str(save_path), source_name=source_name)
-        total_chunks = corpus_size()
-        return {
-            "status": "ok",
-            "file": file.filename,
-            "chunks_added": chunks_added,
-            "total_chunks": total_chunks,
-        }
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+    # Stream to disk in 1 MB pieces so large uploads never sit fully in RAM.
+    # The job id prefix keeps same-named uploads from overwriting each other
+    # while an earlier one is still queued or being read.
+    job_id = uuid4().hex
+    save_path = UPLOAD_DIR / f"{job_id}_{Path(file.filename).name}"
+    async with aiofiles.open(save_path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            await f.write(chunk)
+
+    # Indexing can take tens of seconds; answer now and let the UI poll
+    job = {"job_id": job_id, "status": "pending", "file": file.filename}
+    await save_job(job)
+    background_tasks.add_task(_run_ingest, job, save_path, source_name)
+    return ORJSONResponse(
+        {"status": "accepted", "job_id": job_id, "file": file.filename},
+        status_code=202,
+    )
+
+
+@app.get("/upload_status/{job_id}")
+async def upload_status(job_id: str):
+    job = await get_job(job_id)
+    if job is None:
+        return JSONResponse({"error": "Unknown job"}, status_code=404)
+    return ORJSONResponse(job)
 
 
 @app.post("/search")
 async def search_docs(req: SearchRequest):
-    hits = query_corpus(req.query, top_k=req.top_k)
-    return {"results": hits}
+    # Embedding + HNSW search would block the event loop (and every stream)
+    hits = await asyncio.to_thread(query_corpus, req.query, req.top_k)
+    return ORJSONResponse({"results": hits})
 
 
 @app.post("/clear_session")
 async def clear_session(req: ClearSessionRequest):
-    clear_history(req.session_id)
+    await clear_history(req.session_id)
     return {"status": "cleared", "session_id": req.session_id}
 
 
 @app.post("/export_chat")
 async def export_chat(req: ExportRequest):
-    history = get_history(req.session_id)
+    history = await get_history(req.session_id)
     if not history:
         return JSONResponse({"error": "No messages for this session"}, status_code=404)
 
@@ -238,52 +353,34 @@ async def export_chat(req: ExportRequest):
 
     if fmt == "pdf":
         from io import BytesIO
+        import html
         from reportlab.lib.pagesizes import letter
-        from reportlab.pdfgen import canvas
-        from reportlab.lib.units import inch
-        import textwrap
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 
+        # Platypus wraps each paragraph once with cached font metrics
         buffer = BytesIO()
-        c = canvas.Canvas(buffer, pagesize=letter)
-        width, height = letter
-        margin = 1 * inch
-        y = height - margin
-
-        c.setFont("Helvetica-Bold", 14)
-        c.drawString(margin, y, "Granite Chat Export")
-        y -= 18
-
-        c.setFont("Helvetica", 10)
-        c.drawString(margin, y, f"Session ID: {req.session_id}")
-        y -= 24
-
-        wrap_width = 95
+        doc = SimpleDocTemplate(buffer, pagesize=letter)
+        styles = getSampleStyleSheet()
+        story = [
+            Paragraph("Granite Chat Export", styles["Title"]),
+            Paragraph(f"Session ID: {html.escape(req.session_id)}", styles["Normal"]),
+            Spacer(1, 12),
+        ]
 
         for m in history:
-            role = m.get("role", "").capitalize()
-            content = (m.get("content", "") or "").replace("\r", "")
-
-            if y <= margin:
-                c.showPage()
-                y = height - margin
-
-            c.setFont("Helvetica-Bold", 10)
-            c.drawString(margin, y, f"{role}:")
-            y -= 14
-
-            c.setFont("Helvetica", 10)
+            role = html.escape(m.get("role", "").capitalize())
+            content = html.escape((m.get("content", "") or "").replace("\r", "").expandtabs(4))
+            # Paragraph collapses runs of spaces; keep indentation (code) as &nbsp;
+            lines = []
             for line in content.split("\n"):
-                for subline in textwrap.wrap(line, width=wrap_width):
-                    if y <= margin:
-                        c.showPage()
-                        y = height - margin
-                        c.setFont("Helvetica", 10)
-                    c.drawString(margin + 20, y, subline)
-                    y -= 12
-            y -= 8
-
-        c.showPage()
-        c.save()
+                stripped = line.lstrip(" ")
+                lines.append("&nbsp;" * (len(line) - len(stripped)) + stripped)
+            content = "<br/>".join(lines)
+            story.append(Paragraph(f"<b>{role}:</b> {content}", styles["BodyText"]))
+            story.append(Spacer(1, 6))
+
+        doc.build(story)
         buffer.seek(0)
         return StreamingResponse(
             buffer,
@@ -296,4 +393,4 @@ async def export_chat(req: ExportRequest):
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "corpus_chunks": corpus_size()}
+    return ORJSONResponse({"status": "ok", "corpus_chunks": corpus_size()})
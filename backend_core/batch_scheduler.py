@@ -0,0 +1,442 @@
+# backend_core/batch_scheduler.py
+
+"""
+Continuous (iteration-level) batching for the Granite LLM.
+
+Instead of one model.generate() thread per /chat_stream request, a single
+worker thread owns the model and decodes all active requests together:
+
+- New requests wait in a queue and join the running batch between steps
+- Each new request is prefilled on its own, then its KV cache is
+  left-padded and stacked onto the running batch
+- Every decode step feeds the last sampled token of every row in one
+  forward pass, so concurrent users share the weight reads
+- Sampled tokens are pushed into each request's streamer
+- Finished rows are evicted and their slot is given to the next request
+- Extend jobs (submit_extend) prefill text onto a cache without sampling,
+  e.g. to build the next turn's conversation cache
+
+All model calls run under torch.inference_mode(), so cached KV tensors are
+inference tensors and must only be used inside inference mode.
+
+KV caches are handled in the "legacy" layout: a tuple with one (key, value)
+pair per layer, each tensor shaped (batch, heads, seq_len, head_dim).
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Set, Union
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache, PreTrainedModel
+
+from model_loader import (
+    batch_tokenize,
+    get_llm,
+    get_llm_tokenizer,
+    get_prefix_kv,
+    to_legacy_cache,
+)
+
+MAX_BATCH_SIZE = 8
+
+_requests: "queue.Queue[Union[GenerationRequest, _ExtendRequest]]" = queue.Queue()
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+
+
+class GenerationRequest:
+    """
+    One chat completion waiting for / taking part in the running batch.
+    context and then prompt are prefilled on top of past_key_values, or on
+    top of the cached KV of build_prompt_prefix(mode) when no cache is given.
+    streamer receives token ids via put() and end(), like with model.generate().
+
+    base_past holds the KV cache up to the end of context (before prompt),
+    so the caller can extend it with the finished turn (see submit_extend)
+    without keeping prompt-only text such as RAG snippets. It stays None if
+    prefill failed. If prefill or decoding fails, error holds the message.
+    Both are set before streamer.end().
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        streamer,
+        mode: str = "general",
+        context: str = "",
+        past_key_values=None,
+        max_new_tokens: int = 400,
+        temperature: float = 0.3,
+        top_p: float = 0.9,
+    ):
+        self.prompt = prompt
+        self.streamer = streamer
+        self.mode = mode
+        self.context = context
+        self.past_key_values = past_key_values
+        self.base_past = None
+        self.hit_eos = False
+        self.error: Optional[str] = None
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated: List[int] = []
+
+    def emit(self, token_id: int, eos_ids: Set[int]) -> bool:
+        """
+        Record a sampled token and stream it.
+        Returns True when the request is finished.
+        """
+        if token_id in eos_ids:
+            self.hit_eos = True
+            return True
+        self.generated.append(token_id)
+        self.streamer.put(torch.tensor([token_id]))
+        return len(self.generated) >= self.max_new_tokens
+
+    def finish(self, error: Optional[str] = None) -> None:
+        if error is not None:
+            self.error = error
+        self.streamer.end()
+
+
+class _ExtendRequest:
+    """
+    Prefill text on top of past_key_values; future receives the new cache.
+    """
+
+    def __init__(self, past_key_values, text: str, future: Future):
+        self.past_key_values = past_key_values
+        self.text = text
+        self.future = future
+
+
+# --------- KV cache helpers ---------
+
+
+def _to_model_cache(model, past):
+    if past is None:
+        return None
+    if isinstance(model, PreTrainedModel):
+        # from_legacy_cache was removed in transformers 5; the constructor
+        # takes the same ((key, value), ...) layout there
+        if hasattr(DynamicCache, "from_legacy_cache"):
+            return DynamicCache.from_legacy_cache(past)
+        return DynamicCache(past)
+    return past
+
+
+def _forward(model, input_ids, attention_mask, position_ids, past):
+    """
+    One forward pass. Returns (last-position logits, legacy cache).
+    """
+    outputs = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=_to_model_cache(model, past),
+        use_cache=True,
+    )
+    return outputs.logits[:, -1, :].float(), to_legacy_cache(outputs.past_key_values)
+
+
+def _prefill(model, device: torch.device, input_ids: List[int], past):
+    """
+    Run input_ids on top of past (a single-row cache or None).
+    Returns (last-position logits, legacy cache).
+    """
+    ids = torch.tensor([input_ids], device=device)
+    past_len = past[0][0].shape[2] if past else 0
+    seq_len = past_len + ids.shape[1]
+    mask = torch.ones((1, seq_len), dtype=torch.long, device=device)
+    positions = torch.arange(past_len, seq_len, device=device).unsqueeze(0)
+    return _forward(model, ids, mask, positions, past)
+
+
+def _pad_left(past, mask: torch.Tensor, target_len: int):
+    pad = target_len - mask.shape[1]
+    if pad <= 0:
+        return past, mask
+    past = tuple(
+        (F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))) for k, v in past
+    )
+    return past, F.pad(mask, (pad, 0))
+
+
+def _sample(logits: torch.Tensor, temperature: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    """
+    Temperature + nucleus sampling for a (batch, vocab) logits tensor.
+    temperature and top_p are (batch, 1) so each row keeps its own settings.
+    """
+    probs = torch.softmax(logits / temperature.clamp(min=1e-5), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    # Drop tokens once the mass *before* them already exceeds top_p
+    sorted_probs = sorted_probs.masked_fill(cumulative - sorted_probs > top_p, 0.0)
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    return sorted_idx.gather(-1, choice).squeeze(-1)
+
+
+# --------- Running batch ---------
+
+
+class _Batch:
+    """
+    Decode state shared by all active rows.
+    """
+
+    def __init__(self, model, device: torch.device, eos_ids: Set[int]):
+        self.model = model
+        self.device = device
+        self.eos_ids = eos_ids
+        self.rows: List[GenerationRequest] = []
+        self.past = None
+        self.mask: Optional[torch.Tensor] = None  # (batch, seq_len), 0 = left padding
+        self.next_tokens: Optional[torch.Tensor] = None  # (batch,) sampled, not yet fed
+        self.positions: Optional[torch.Tensor] = None  # (batch,) position id of next_tokens
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _sample_rows(self, logits: torch.Tensor, rows: List[GenerationRequest]) -> torch.Tensor:
+        temperature = torch.tensor([[r.temperature] for r in rows], device=logits.device)
+        top_p = torch.tensor([[r.top_p] for r in rows], device=logits.device)
+        return _sample(logits, temperature, top_p)
+
+    def admit(self, req: GenerationRequest, input_ids: List[int], prefix_past) -> None:
+        """
+        Prefill a new request on top of prefix_past and stack it onto the batch.
+        """
+        logits, past = _prefill(self.model, self.device, input_ids, prefix_past)
+        token = self._sample_rows(logits, [req])
+        if req.emit(int(token[0]), self.eos_ids):
+            req.finish()
+            return
+
+        seq_len = past[0][0].shape[2]
+        mask = torch.ones((1, seq_len), dtype=torch.long, device=self.device)
+        position = torch.tensor([seq_len], device=self.device)
+        if not self.rows:
+            self.rows = [req]
+            self.past, self.mask = past, mask
+            self.next_tokens, self.positions = token, position
+            return
+
+        target_len = max(self.mask.shape[1], mask.shape[1])
+        self.past, self.mask = _pad_left(self.past, self.mask, target_len)
+        past, mask = _pad_left(past, mask, target_len)
+
+        self.rows.append(req)
+        self.past = tuple(
+            (torch.cat([k0, k1]), torch.cat([v0, v1]))
+            for (k0, v0), (k1, v1) in zip(self.past, past)
+        )
+        self.mask = torch.cat([self.mask, mask])
+        self.next_tokens = torch.cat([self.next_tokens, token])
+        self.positions = torch.cat([self.positions, position])
+
+    def step(self) -> None:
+        """
+        Feed every row's pending token in one forward pass and sample the next.
+        """
+        ones = torch.ones((len(self.rows), 1), dtype=torch.long, device=self.device)
+        self.mask = torch.cat([self.mask, ones], dim=1)
+        logits, self.past = _forward(
+            self.model,
+            self.next_tokens.unsqueeze(1),
+            self.mask,
+            self.positions.unsqueeze(1),
+            self.past,
+        )
+        self.positions = self.positions + 1
+        self.next_tokens = self._sample_rows(logits, self.rows)
+
+        keep: List[int] = []
+        for i, (req, token) in enumerate(zip(self.rows, self.next_tokens.tolist())):
+            if req.emit(token, self.eos_ids):
+                req.finish()
+            else:
+                keep.append(i)
+        if len(keep) < len(self.rows):
+            self._evict(keep)
+
+    def _evict(self, keep: List[int]) -> None:
+        if not keep:
+            self.reset()
+            return
+
+        idx = torch.tensor(keep, device=self.device)
+        self.rows = [self.rows[i] for i in keep]
+        self.mask = self.mask.index_select(0, idx)
+        self.next_tokens = self.next_tokens.index_select(0, idx)
+        self.positions = self.positions.index_select(0, idx)
+
+        # Drop padding columns no remaining row needs any more
+        start = int((self.mask.sum(dim=0) > 0).nonzero()[0])
+        self.mask = self.mask[:, start:]
+        self.past = tuple(
+            (k.index_select(0, idx)[:, :, start:], v.index_select(0, idx)[:, :, start:])
+            for k, v in self.past
+        )
+
+    def reset(self) -> None:
+        self.rows = []
+        self.past = self.mask = self.next_tokens = self.positions = None
+
+    def abort(self, error: str) -> None:
+        """
+        Close every stream with error (used after an unexpected error).
+        """
+        for req in self.rows:
+            req.finish(error)
+        self.reset()
+
+
+# --------- Worker ---------
+
+
+def _eos_ids(model, tokenizer) -> Set[int]:
+    ids: Set[int] = set()
+    if tokenizer.eos_token_id is not None:
+        ids.add(tokenizer.eos_token_id)
+    config_eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+    if isinstance(config_eos, int):
+        ids.add(config_eos)
+    elif config_eos:
+        ids.update(config_eos)
+    return ids
+
+
+def _run_extend(model, tokenizer, device: torch.device, job: _ExtendRequest) -> None:
+    if not job.future.set_running_or_notify_cancel():
+        return
+    try:
+        input_ids = tokenizer(job.text, add_special_tokens=False)["input_ids"]
+        with torch.inference_mode():
+            _logits, past = _prefill(model, device, input_ids, job.past_key_values)
+    except Exception as e:
+        print(f"[batch_scheduler] Extend failed: {e}")
+        job.future.set_exception(e)
+        return
+    job.future.set_result(past)
+
+
+def _worker_loop() -> None:
+    model = get_llm()
+    tokenizer = get_llm_tokenizer()
+    device = model.device if hasattr(model, "device") else torch.device("cpu")
+    batch = _Batch(model, device, _eos_ids(model, tokenizer))
+
+    while True:
+        # Block while idle; otherwise only pick up what is already waiting
+        new: List[GenerationRequest] = []
+        if not batch:
+            new.append(_requests.get())
+        while len(batch) + len(new) < MAX_BATCH_SIZE:
+            try:
+                new.append(_requests.get_nowait())
+            except queue.Empty:
+                break
+
+        # Extend jobs never join the batch; run them right away
+        for job in [r for r in new if isinstance(r, _ExtendRequest)]:
+            _run_extend(model, tokenizer, device, job)
+        new = [r for r in new if isinstance(r, GenerationRequest)]
+
+        # One tokenizer call for everything that arrived this round
+        if new:
+            try:
+                encoded = batch_tokenize([req.prompt for req in new], add_special_tokens=False)
+            except Exception as e:
+                print(f"[batch_scheduler] Tokenization failed: {e}")
+                for req in new:
+                    req.finish(str(e))
+                new = []
+
+        for row, req in enumerate(new):
+            try:
+                input_ids = encoded["input_ids"][row][encoded["attention_mask"][row].bool()].tolist()
+                base_past = req.past_key_values or get_prefix_kv(req.mode)
+                with torch.inference_mode():
+                    if req.context:
+                        # Not truncated (unlike batch_tokenize): a cache hit
+                        # always covers the whole history, so must a rebuild
+                        context_ids = tokenizer(req.context, add_special_tokens=False)["input_ids"]
+                        _logits, base_past = _prefill(model, device, context_ids, base_past)
+                    req.base_past = base_past
+                    batch.admit(req, input_ids, base_past)
+            except Exception as e:
+                print(f"[batch_scheduler] Prefill failed: {e}")
+                req.finish(str(e))
+
+        if not batch:
+            continue
+
+        try:
+            with torch.inference_mode():
+                batch.step()
+        except Exception as e:
+            print(f"[batch_scheduler] Decode step failed: {e}")
+            batch.abort(str(e))
+
+
+def _ensure_worker() -> None:
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_worker_loop, name="llm-batch-scheduler", daemon=True)
+        _worker.start()
+        print("[batch_scheduler] Worker started.")
+
+
+def submit_generation(
+    prompt: str,
+    streamer,
+    mode: str = "general",
+    context: str = "",
+    past_key_values=None,
+    max_new_tokens: int = 400,
+    temperature: float = 0.3,
+    top_p: float = 0.9,
+) -> GenerationRequest:
+    """
+    Queue a prompt for generation. context is the history section
+    (utils_core.build_history_section) and prompt the per-turn text
+    (build_turn_prompt); the prefix for mode is served from the KV cache.
+    Pass past_key_values (legacy tuple form) to continue from an existing
+    conversation cache instead; context + prompt then hold only the new text.
+    The cache after context is kept as the request's base_past.
+    Tokens are pushed into streamer (e.g. a TextIteratorStreamer) as they
+    are sampled; streamer.end() is called when the request finishes.
+    Check the returned request's error after the stream ends.
+    """
+    req = GenerationRequest(
+        prompt,
+        streamer,
+        mode=mode,
+        context=context,
+        past_key_values=past_key_values,
+        max_new_tokens=max_new_tokens,
+        temperature=temperature,
+        top_p=top_p,
+    )
+    _ensure_worker()
+    _requests.put(req)
+    return req
+
+
+def submit_extend(past_key_values, text: str) -> Future:
+    """
+    Queue text to be prefilled on top of past_key_values (legacy tuple form)
+    by the worker. The returned future resolves to the extended cache.
+    """
+    future: Future = Future()
+    _ensure_worker()
+    _requests.put(_ExtendRequest(past_key_values, text, future))
+    return future
@@ -171,6 +171,18 @@ async function clearSessionOnServer() {
   }
 }
 
+// Indexing runs in the background on the server; poll until it finishes
+async function waitForUploadJob(jobId) {
+  while (true) {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    const res = await fetch(`${API_BASE}/upload_status/${jobId}`);
+    const data = await res.json();
+    if (!res.ok || data.status === "ok" || data.status === "error") {
+      return data;
+    }
+  }
+}
+
 async function uploadFile() {
   const file = fileInput.files[0];
   if (!file) return alert("Choose a file first.");
@@ -188,7 +200,11 @@ async function uploadFile() {
       method: "POST",
       body: formData,
     });
-    const data = await res.json();
+    let data = await res.json();
+    if (data.status === "accepted") {
+      uploadBtn.textContent = "Indexing...";
+      data = await waitForUploadJob(data.job_id);
+    }
     if (data.status === "ok") {
       corpusCountLabel.textContent = data.total_chunks ?? corpusCountLabel.textContent;
       alert(`Indexed ${data.chunks_added} chunks from ${data.file}`);
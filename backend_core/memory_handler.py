@@ -1,34 +1,101 @@
 # backend_core/memory_handler.py
 
-from typing import Dict, List
+"""
+Conversation memory.
 
-# In-memory store: session_id -> list of {role, content}
+Messages live in Redis when REDIS_URL is set (one list per session,
+shared by all uvicorn workers, expiring after SESSION_TTL_SECONDS of
+inactivity). Without REDIS_URL they fall back to an in-process dict.
+Upload job status is kept the same way, so with REDIS_URL any uvicorn
+worker can answer /upload_status; without it, run a single worker.
+
+The per-session LLM KV cache is always process-local.
+"""
+
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL_SECONDS = 7 * 24 * 3600
+
+_redis = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+
+    _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    print("[memory_handler] Using Redis session store.")
+
+# Fallback in-memory store: session_id -> list of {role, content}
 _conversations: Dict[str, List[Dict[str, str]]] = {}
 
+# Per-session LLM KV cache: session_id -> (mode, n_messages, past_key_values).
+# Lets the next turn prefill only its own tokens instead of the whole
+# conversation. n_messages is the history length the cache covers, so a
+# cache that missed turns served by another worker is not reused.
+# It holds only prompt prefix + history section (no RAG snippets), the same
+# text a rebuild from history would prefill, so dropping an entry costs one
+# re-prefill but never changes the prompt.
+# Both paths always see the whole history (the rebuilt history is not
+# truncated either).
+# KV caches are large (~160 KB per token for Granite 2B in FP32, so ~640 MB
+# at MAX_KV_TOKENS). 4096 tokens fit roughly 8 turns with full 400-token
+# answers; longer conversations are not cached and re-prefill their full
+# history every turn.
+MAX_KV_SESSIONS = 4
+MAX_KV_TOKENS = 4096
+_kv_caches: "OrderedDict[str, Tuple[str, int, Any]]" = OrderedDict()
+
+# Upload ingest jobs: job_id -> {job_id, status, file, ...}
+# status: "pending" -> "running" -> "ok" | "error"
+# Redis entries expire after JOB_TTL_SECONDS; the in-process fallback keeps
+# only the newest MAX_FINISHED_JOBS finished jobs.
+JOB_TTL_SECONDS = 24 * 3600
+MAX_FINISHED_JOBS = 256
+_jobs: Dict[str, Dict[str, Any]] = {}
+
 
-def add_message(session_id: str, role: str, content: str) -> None:
+def _redis_key(session_id: str) -> str:
+    return f"chat:{session_id}"
+
+
+async def add_message(session_id: str, role: str, content: str) -> None:
     """
     Append a message to a session conversation.
     role: "user" or "assistant"
     """
     if not session_id:
         session_id = "default"
+    message = {"role": role, "content": content}
+
+    if _redis is not None:
+        key = _redis_key(session_id)
+        async with _redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, json.dumps(message))
+            pipe.expire(key, SESSION_TTL_SECONDS)
+            await pipe.execute()
+        return
+
     conv = _conversations.setdefault(session_id, [])
-    conv.append({"role": role, "content": content})
+    conv.append(message)
 
 
-def get_history(session_id: str) -> List[Dict[str, str]]:
+async def get_history(session_id: str) -> List[Dict[str, str]]:
     """
     Return the list of messages for this session.
     """
+    if _redis is not None:
+        raw = await _redis.lrange(_redis_key(session_id), 0, -1)
+        return [json.loads(item) for item in raw]
     return list(_conversations.get(session_id, []))
 
 
-def format_history_for_prompt(session_id: str) -> str:
+def format_history_for_prompt(conv: List[Dict[str, str]]) -> str:
     """
-    Format the conversation as plain text for the LLM prompt.
+    Format the conversation (messages from get_history) as plain text
+    for the LLM prompt.
     """
-    conv = _conversations.get(session_id, [])
     lines = []
     for msg in conv:
         role = msg.get("role", "user")
@@ -37,8 +104,69 @@ def format_history_for_prompt(session_id: str) -> str:
     return "\n".join(lines)
 
 
-def clear_history(session_id: str) -> None:
+def get_kv(session_id: str, mode: str, n_messages: int) -> Optional[Any]:
+    """
+    Return the cached past_key_values for this session, or None if there is
+    none, it was built for a different mode, or it does not cover exactly
+    the n_messages currently in the history.
+    """
+    entry = _kv_caches.get(session_id)
+    if entry is None or entry[0] != mode or entry[1] != n_messages:
+        return None
+    _kv_caches.move_to_end(session_id)
+    return entry[2]
+
+
+def set_kv(session_id: str, mode: str, n_messages: int, past: Optional[Any]) -> None:
+    """
+    Store the KV cache covering the first n_messages of the conversation.
+    past is in legacy tuple form; None (or an over-long cache) drops it.
+    """
+    if past is None or past[0][0].shape[2] > MAX_KV_TOKENS:
+        _kv_caches.pop(session_id, None)
+        return
+    _kv_caches[session_id] = (mode, n_messages, past)
+    _kv_caches.move_to_end(session_id)
+    while len(_kv_caches) > MAX_KV_SESSIONS:
+        _kv_caches.popitem(last=False)
+
+
+def _job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+async def save_job(job: Dict[str, Any]) -> None:
+    """
+    Create or overwrite the record of an upload job (keyed by job["job_id"]).
+    """
+    if _redis is not None:
+        await _redis.set(_job_key(job["job_id"]), json.dumps(job), ex=JOB_TTL_SECONDS)
+        return
+
+    _jobs[job["job_id"]] = dict(job)
+    # Dicts keep insertion order, so the first finished entries are the oldest
+    finished = [job_id for job_id, j in _jobs.items() if j["status"] in ("ok", "error")]
+    for job_id in finished[:-MAX_FINISHED_JOBS]:
+        del _jobs[job_id]
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the record of an upload job, or None if it is unknown or expired.
+    """
+    if _redis is not None:
+        raw = await _redis.get(_job_key(job_id))
+        return json.loads(raw) if raw is not None else None
+    job = _jobs.get(job_id)
+    return dict(job) if job is not None else None
+
+
+async def clear_history(session_id: str) -> None:
     """
-    Remove all messages for this session.
+    Remove all messages (and the cached KV) for this session.
     """
+    _kv_caches.pop(session_id, None)
+    if _redis is not None:
+        await _redis.delete(_redis_key(session_id))
+        return
     _conversations.pop(session_id, None)
@@ -1,8 +1,10 @@
 # backend_core/model_loader.py
 
+import os
 import threading
 import sys
-from typing import List
+from pathlib import Path
+from typing import Dict, List
 
 import numpy as np
 
@@ -37,12 +39,18 @@ from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     AutoModel,
+    BitsAndBytesConfig,
 )
 
+from utils_core import build_prompt_prefix
+
 # ---- MODEL NAMES (change here if needed) ----
 LLM_MODEL_NAME = "ibm-granite/granite-3.1-2b-instruct"
 EMBED_MODEL_NAME = "ibm-granite/granite-embedding-125m-english"
 
+# The OpenVINO INT8 export of LLM_MODEL_NAME is cached here (CPU path)
+OV_MODEL_DIR = Path(__file__).resolve().parent / "ov_models" / (LLM_MODEL_NAME.split("/")[-1] + "-int8")
+
 # Global singletons
 _llm = None
 _llm_tokenizer = None
@@ -50,17 +58,128 @@ _embed_model = None
 _embed_tokenizer = None
 _load_lock = threading.Lock()
 
+# Prefilled KV caches for the static prompt prefix, keyed by prefix text
+_prefix_kv: Dict[str, tuple] = {}
+
+# Embedding batching: texts are length-sorted and embedded in buckets this size
+EMBED_BATCH_SIZE = 32
+EMBED_MAX_LENGTH = 512
+
 
 def _get_device() -> torch.device:
     """
     Decide where to run the models.
-    We default to CPU to avoid GPU out-of-memory on small VRAM.
-    You can change to CUDA manually later if you want.
+    The LLM is quantized (4-bit on GPU, INT8 on CPU), so even small VRAM
+    cards can hold it; use CUDA whenever it is available.
     """
-    # If you want to try GPU, change "cpu" to "cuda" (if available)
+    if torch.cuda.is_available():
+        return torch.device("cuda")
     return torch.device("cpu")
 
 
+def _load_llm(device: torch.device):
+    """
+    Load the Granite LLM with quantized weights.
+
+    Decoding is bound by reading every weight once per generated token,
+    so fewer weight bytes means proportionally more tokens/sec.
+    - CUDA: bitsandbytes 4-bit (NF4 weights, bf16 compute)
+    - CPU: OpenVINO INT8 via optimum-intel
+    Without bitsandbytes the LLM runs on the CPU path instead (an
+    unquantized model may not fit small GPUs).
+    """
+    if device.type == "cuda":
+        try:
+            quant_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+            return AutoModelForCausalLM.from_pretrained(
+                LLM_MODEL_NAME,
+                quantization_config=quant_config,
+                device_map={"": device.index or 0},
+            )
+        except ImportError as e:
+            print(f"[model_loader] bitsandbytes not available ({e}); loading the LLM on CPU.")
+
+    return _load_llm_cpu()
+
+
+def _load_llm_cpu():
+    """
+    OpenVINO INT8 model, exported once to OV_MODEL_DIR and reloaded from
+    there on later starts. Falls back to the plain FP32 model if
+    optimum-intel is missing.
+    """
+    try:
+        from optimum.intel.openvino import OVModelForCausalLM
+    except ImportError:
+        print(
+            "[model_loader] optimum-intel not installed; falling back to FP32.\n"
+            "               pip install optimum[openvino] for INT8 CPU inference."
+        )
+        return AutoModelForCausalLM.from_pretrained(
+            LLM_MODEL_NAME,
+            torch_dtype=torch.float32,
+        )
+
+    if (OV_MODEL_DIR / "openvino_model.xml").exists():
+        print(f"[model_loader] Loading exported OpenVINO model from {OV_MODEL_DIR}")
+        return OVModelForCausalLM.from_pretrained(OV_MODEL_DIR)
+
+    # stateful=False keeps past_key_values as explicit inputs/outputs,
+    # which the batch scheduler needs to stack and evict rows.
+    # It is baked into the exported model, so the saved copy keeps it.
+    model = OVModelForCausalLM.from_pretrained(
+        LLM_MODEL_NAME,
+        export=True,
+        load_in_8bit=True,
+        stateful=False,
+    )
+    model.save_pretrained(OV_MODEL_DIR)
+    print(f"[model_loader] Saved exported OpenVINO model to {OV_MODEL_DIR}")
+    return model
+
+
+def _embed_dtype(device: torch.device) -> torch.dtype:
+    """
+    Half-precision dtype for the embedding model: FP16 on GPU, BF16 on CPU.
+    """
+    return torch.float16 if device.type == "cuda" else torch.bfloat16
+
+
+def _compile_embed_model(model, device: torch.device):
+    """
+    torch.compile the embedding model and run one warm-up batch, so the
+    compile cost is paid at startup instead of on the first upload.
+    dynamic=True lets new batch / sequence lengths reuse the same graph.
+    Returns the eager model if compiling fails (e.g. no inductor toolchain).
+    """
+    try:
+        compiled = torch.compile(model, dynamic=True)
+        warmup = torch.ones((2, 16), dtype=torch.long, device=device)
+        with torch.inference_mode():
+            _run_embed_model(compiled, warmup, warmup, device)
+        return compiled
+    except Exception as e:
+        print(f"[model_loader] torch.compile failed ({e}); using the eager embedding model.")
+        return model
+
+
+def _configure_torch_threads() -> None:
+    """
+    Use half the cores for intra-op parallelism and a single inter-op thread,
+    leaving room for uvicorn's threadpool instead of oversubscribing the CPU.
+    """
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before any inter-op work has run in this process
+        pass
+    print(f"[model_loader] torch threads: {torch.get_num_threads()}")
+
+
 def load_models():
     """
     Lazy-load all models once. Called from app startup.
@@ -74,26 +193,32 @@ def load_models():
         if _llm is not None and _embed_model is not None:
             return
 
+        _configure_torch_threads()
         device = _get_device()
 
         # ---- Load LLM ----
         print(f"[model_loader] Loading LLM on {device}...")
-        _llm_tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_NAME)
-        _llm = AutoModelForCausalLM.from_pretrained(
-            LLM_MODEL_NAME,
-            torch_dtype=torch.float32,
-        ).to(device)
-        _llm.eval()
+        _llm_tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_NAME, use_fast=True)
+        assert _llm_tokenizer.is_fast, "Rust-backed fast tokenizer required for the LLM"
+        if _llm_tokenizer.pad_token is None:
+            _llm_tokenizer.pad_token = _llm_tokenizer.eos_token
+        # If a prompt is too long, drop the oldest text, not the new user turn
+        _llm_tokenizer.truncation_side = "left"
+        _llm = _load_llm(device)
+        if hasattr(_llm, "eval"):
+            _llm.eval()
         print("[model_loader] LLM loaded.")
 
         # ---- Load embedding model ----
         print(f"[model_loader] Loading embedding model on {device}...")
-        _embed_tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME)
+        _embed_tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME, use_fast=True)
         _embed_model = AutoModel.from_pretrained(
             EMBED_MODEL_NAME,
-            torch_dtype=torch.float32,
+            torch_dtype=_embed_dtype(device),
+            attn_implementation="sdpa",
         ).to(device)
         _embed_model.eval()
+        _embed_model = _compile_embed_model(_embed_model, device)
         print("[model_loader] Embedding model loaded.")
 
 
@@ -109,6 +234,67 @@ def get_llm_tokenizer():
     return _llm_tokenizer
 
 
+def batch_tokenize(prompts: List[str], add_special_tokens: bool = True):
+    """
+    Tokenize several LLM prompts in one call to the Rust tokenizer.
+    Returns padded input_ids / attention_mask tensors (max 2048 tokens each).
+    """
+    tokenizer = get_llm_tokenizer()
+    return tokenizer(
+        prompts,
+        padding=True,
+        truncation=True,
+        max_length=2048,
+        add_special_tokens=add_special_tokens,
+        return_tensors="pt",
+    )
+
+
+def to_legacy_cache(past):
+    """
+    Normalize a model's past_key_values into a tuple of (key, value) tensors,
+    one pair per layer, each shaped (batch, heads, seq_len, head_dim).
+    """
+    if past is None:
+        return None
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    if hasattr(past, "layers"):
+        # transformers 5 Cache objects no longer have to_legacy_cache()
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    # OpenVINO (stateless export) returns numpy views of its output buffers,
+    # which are overwritten by the next inference, so copy them.
+    return tuple(
+        tuple(t if isinstance(t, torch.Tensor) else torch.tensor(t) for t in layer)
+        for layer in past
+    )
+
+
+def get_prefix_kv(mode: str):
+    """
+    KV cache of build_prompt_prefix(mode), prefilled once and reused.
+    The system + mode instructions never change between turns, so only the
+    per-turn suffix of the prompt has to go through the model.
+
+    Returned in legacy tuple form (see to_legacy_cache); treat it as read-only.
+    Not thread-safe: call it from the thread that runs the LLM.
+    """
+    prefix = build_prompt_prefix(mode)
+    cached = _prefix_kv.get(prefix)
+    if cached is None:
+        model = get_llm()
+        tokenizer = get_llm_tokenizer()
+        device = model.device if hasattr(model, "device") else torch.device("cpu")
+
+        inputs = tokenizer(prefix, return_tensors="pt").to(device)
+        with torch.inference_mode():
+            outputs = model(**inputs, use_cache=True)
+        cached = to_legacy_cache(outputs.past_key_values)
+        _prefix_kv[prefix] = cached
+        print(f"[model_loader] Cached prompt prefix KV for mode '{mode}'.")
+    return cached
+
+
 def get_embed_model():
     if _embed_model is None:
         load_models()
@@ -121,31 +307,70 @@ def get_embed_tokenizer():
     return _embed_tokenizer
 
 
-@torch.no_grad()
+def _run_embed_model(model, input_ids: torch.Tensor, attention_mask: torch.Tensor, device: torch.device):
+    """
+    Forward one batch under autocast to the embedding dtype.
+    """
+    with torch.autocast(device.type, dtype=_embed_dtype(device)):
+        return model(input_ids=input_ids, attention_mask=attention_mask)
+
+
+@torch.inference_mode()
+def _embed_batch(input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Forward one padded batch and mean-pool it into (batch, dim) float32 vectors.
+    """
+    model = get_embed_model()
+    device = _get_device()
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+
+    outputs = _run_embed_model(model, input_ids, attention_mask, device)
+    # Typical approach: mean pooling over sequence dimension
+    # Pool in float32: bf16 sums lose precision and numpy has no bf16 dtype
+    last_hidden = outputs.last_hidden_state.float()  # (batch, seq, dim)
+    mask = attention_mask.unsqueeze(-1).float()  # (batch, seq, 1)
+    masked = last_hidden * mask
+    summed = masked.sum(dim=1)
+    counts = mask.sum(dim=1)
+    return summed / torch.clamp(counts, min=1e-9)
+
+
 def embed_texts(texts: List[str]) -> np.ndarray:
     """
     Turn a list of texts into vector embeddings using the Granite embedding model.
     Returns a numpy array of shape (len(texts), dim).
+
+    All texts are tokenized in one batched call, sorted by token length and
+    embedded in buckets of EMBED_BATCH_SIZE, so each batch only pads to its
+    own longest member instead of the longest text overall. Rows come back
+    in the original order.
     """
-    model = get_embed_model()
     tokenizer = get_embed_tokenizer()
-    device = _get_device()
 
-    encoded = tokenizer(
+    all_ids = tokenizer(
         texts,
-        padding=True,
         truncation=True,
-        return_tensors="pt",
-    ).to(device)
+        max_length=EMBED_MAX_LENGTH,
+    )["input_ids"]
+    order = np.argsort([len(ids) for ids in all_ids], kind="stable")
 
-    outputs = model(**encoded)
-    # Typical approach: mean pooling over sequence dimension
-    last_hidden = outputs.last_hidden_state  # (batch, seq, dim)
-    attention_mask = encoded["attention_mask"].unsqueeze(-1)  # (batch, seq, 1)
-    masked = last_hidden * attention_mask
-    summed = masked.sum(dim=1)
-    counts = attention_mask.sum(dim=1)
-    embeddings = summed / torch.clamp(counts, min=1e-9)
+    embeddings = None
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        bucket = order[start:start + EMBED_BATCH_SIZE]
+        # Pad the already-tokenized ids instead of tokenizing the bucket again
+        width = len(all_ids[bucket[-1]])
+        input_ids = torch.full((len(bucket), width), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(bucket), width), dtype=torch.long)
+        for row, i in enumerate(bucket):
+            ids = all_ids[i]
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+            attention_mask[row, :len(ids)] = 1
+
+        vectors = _embed_batch(input_ids, attention_mask).cpu().numpy()
+        if embeddings is None:
+            embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+        # Writing through the permutation un-sorts the rows in place
+        embeddings[bucket] = vectors
 
-    embeddings = embeddings.cpu().numpy().astype("float32")
     return embeddings
@@ -1,25 +1,30 @@
 # backend_core/rag_engine.py
 
 """
-Simple in-memory RAG engine.
+Simple RAG engine.
 
 - Add text from uploaded files (PDF, DOCX, TXT, images)
 - Text is chunked into small pieces
 - Each chunk is embedded with the Granite embedding model
-- We use FAISS for vector search
+- We use FAISS (HNSW, cosine similarity) for vector search
+- Index + chunks are saved to index_store/ so restarts don't re-embed
 """
 
+from functools import lru_cache
+from pathlib import Path
 from typing import List, Dict, Any
+import json
 import os
+import threading
 
 import faiss
 import numpy as np
-from pypdf import PdfReader
+import pypdfium2 as pdfium
 import docx
 from PIL import Image
 import pytesseract
 
-from model_loader import embed_texts
+from model_loader import EMBED_MODEL_NAME, embed_texts, get_embed_tokenizer
 
 # Try to locate Tesseract automatically on Windows
 def _configure_tesseract():
@@ -39,9 +44,20 @@ _configure_tesseract()
 
 # --------- Global in-memory store ---------
 
+# Images are downscaled so the longer side is at most this many pixels before OCR
+OCR_MAX_SIDE = 2000
+
+# Kept apart from vector_store/, where uploads are written, so an uploaded
+# file can never replace the saved index or its sidecar
+INDEX_STORE_DIR = Path(__file__).resolve().parent / "index_store"
+INDEX_PATH = INDEX_STORE_DIR / "faiss.index"
+META_PATH = INDEX_STORE_DIR / "faiss_meta.json"
+
 _index = None  # FAISS index
 _chunks: List[str] = []  # list of chunk texts
 _metadata: List[Dict[str, Any]] = []  # metadata per chunk (source, etc.)
+# Guards the three above: ingest runs in background threads while chats search
+_store_lock = threading.Lock()
 
 
 # --------- Helpers ---------
@@ -50,37 +66,132 @@ _metadata: List[Dict[str, Any]] = []  # metadata per chunk (source, etc.)
 def _ensure_index(dim: int):
     """
     Create FAISS index if it does not exist yet.
+    HNSW graph over inner product; vectors are L2-normalized before add/search,
+    so the score is cosine similarity.
     """
     global _index
     if _index is None:
-        _index = faiss.IndexFlatL2(dim)
+        _index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        _index.hnsw.efConstruction = 200
+        _index.hnsw.efSearch = 64
 
 
-def _chunk_text(text: str, max_chars: int = 800, overlap: int = 200) -> List[str]:
+def _chunk_text(text: str, max_tokens: int = 300, overlap: int = 64) -> List[str]:
     """
-    Simple character-based chunking with overlap.
+    Token-based chunking with overlap.
+    The document is tokenized once with the embedding tokenizer and a
+    max_tokens window slides over the ids, so every chunk fits the
+    embedding model without truncation.
     """
     text = text.replace("\r\n", "\n").replace("\r", "\n")
+    tokenizer = get_embed_tokenizer()
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
     chunks: List[str] = []
 
-    start = 0
-    length = len(text)
-
-    while start < length:
-        end = min(start + max_chars, length)
-        chunk = text[start:end].strip()
-        if chunk:
+    step = max_tokens - overlap
+    for start in range(0, len(ids), step):
+        chunk = tokenizer.decode(ids[start:start + max_tokens])
+        if chunk and not chunk.isspace():
             chunks.append(chunk)
-        if end == length:
+        if start + max_tokens >= len(ids):
             break
-        start = max(0, end - overlap)
 
     return chunks
 
 
+@lru_cache(maxsize=1024)
+def _embed_query_cached(query: str, model_name: str) -> bytes:
+    """
+    Embed a (normalized) search query, memoized.
+    Chat retries and repeated prompts skip the embedding forward pass.
+    model_name is part of the key so a model swap never reuses old vectors.
+    """
+    return embed_texts([query]).tobytes()
+
+
+def embed_query(query: str) -> np.ndarray:
+    """
+    Embedding of a search/chat query as a writable (1, dim) float32 array.
+    Served from the memoized _embed_query_cached.
+    """
+    return np.frombuffer(
+        _embed_query_cached(query.strip().lower(), EMBED_MODEL_NAME),
+        dtype=np.float32,
+    ).reshape(1, -1).copy()
+
+
+# --------- Persistence ---------
+
+
+def save_index() -> None:
+    """
+    Write the FAISS index and the chunk/metadata sidecar (JSON) to index_store/.
+    Both are written to temp files first and moved into place with
+    os.replace (sidecar last), so a crash mid-write never leaves a
+    truncated file behind.
+    """
+    if _index is None:
+        return
+    INDEX_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    index_tmp = INDEX_PATH.with_name(INDEX_PATH.name + ".tmp")
+    meta_tmp = META_PATH.with_name(META_PATH.name + ".tmp")
+    faiss.write_index(_index, str(index_tmp))
+    with meta_tmp.open("w", encoding="utf-8") as f:
+        json.dump({"chunks": _chunks, "metadata": _metadata}, f, ensure_ascii=False)
+    os.replace(index_tmp, INDEX_PATH)
+    os.replace(meta_tmp, META_PATH)
+
+
+def load_index() -> int:
+    """
+    Restore the index and chunk store saved by save_index(), if present.
+    Returns the number of chunks loaded.
+    """
+    global _index, _chunks, _metadata
+
+    if not (INDEX_PATH.exists() and META_PATH.exists()):
+        print("[rag_engine] No saved index found; starting with empty corpus.")
+        return 0
+
+    try:
+        index = faiss.read_index(str(INDEX_PATH))
+        with META_PATH.open("r", encoding="utf-8") as f:
+            meta = json.load(f)
+        chunks, metadata = meta["chunks"], meta["metadata"]
+    except Exception as e:
+        print(f"[rag_engine] Failed to load saved index: {e}")
+        return 0
+
+    if index.ntotal != len(chunks):
+        print("[rag_engine] Saved index and chunk store disagree; ignoring them.")
+        return 0
+
+    with _store_lock:
+        _index, _chunks, _metadata = index, chunks, metadata
+    print(f"[rag_engine] Loaded {len(_chunks)} chunks from {INDEX_PATH}")
+    return len(_chunks)
+
+
 # --------- Document loaders ---------
 
 
+def _load_pdf_text(path: str) -> str:
+    """
+    PDF text via PDFium (C library, much faster than pure-Python parsing).
+    """
+    pdf = pdfium.PdfDocument(path)
+    try:
+        pages: List[str] = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            pages.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return "\n\n".join(pages)
+    finally:
+        pdf.close()
+
+
 def load_text_from_file(path: str) -> str:
     """
     Load text from a PDF, DOCX, TXT file or image (PNG/JPG/etc.).
@@ -90,11 +201,7 @@ def load_text_from_file(path: str) -> str:
 
     # PDF
     if ext == ".pdf":
-        reader = PdfReader(path)
-        pages = []
-        for page in reader.pages:
-            pages.append(page.extract_text() or "")
-        text = "\n\n".join(pages)
+        text = _load_pdf_text(path)
         print(f"[rag_engine] Extracted {len(text)} chars from PDF")
         return text
 
@@ -117,8 +224,14 @@ def load_text_from_file(path: str) -> str:
     elif ext in (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tiff"):
         print(f"[rag_engine] Running OCR on image {path}")
         try:
-            img = Image.open(path)
-            text = pytesseract.image_to_string(img)
+            # Grayscale + cap the long side: Tesseract time grows with pixels
+            img = Image.open(path).convert("L")
+            w, h = img.size
+            scale = min(1.0, OCR_MAX_SIDE / max(w, h))
+            if scale < 1.0:
+                img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
+            # LSTM engine, single uniform block of text (no layout analysis)
+            text = pytesseract.image_to_string(img, config="--oem 1 --psm 6", lang="eng")
             print(f"[rag_engine] OCR extracted {len(text)} chars from image")
             return text
         except Exception as e:
@@ -158,16 +271,18 @@ def add_document_from_text(text: str, source_name: str) -> int:
     embeddings = embed_texts(chunks)  # (n_chunks, dim)
     n_chunks, dim = embeddings.shape
 
-    # Ensure FAISS index
-    _ensure_index(dim)
+    # Add to FAISS (unit vectors, so inner product == cosine)
+    faiss.normalize_L2(embeddings)
+    with _store_lock:
+        _ensure_index(dim)
+        _index.add(embeddings)
 
-    # Add to FAISS
-    _index.add(embeddings)
+        # Save chunks + metadata
+        for chunk in chunks:
+            _chunks.append(chunk)
+            _metadata.append({"source": source_name})
 
-    # Save chunks + metadata
-    for chunk in chunks:
-        _chunks.append(chunk)
-        _metadata.append({"source": source_name})
+        save_index()
 
     print(f"[rag_engine] Added {n_chunks} chunks from source '{source_name}'")
     return n_chunks
@@ -199,29 +314,32 @@ def corpus_size() -> int:
 def query_corpus(query: str, top_k: int = 4) -> List[Dict[str, Any]]:
     """
     Search the RAG corpus for the most relevant chunks.
-    Returns a list of dicts: {text, score, source}
+    Returns a list of dicts: {text, score, source}, best match first.
+    score is the cosine similarity in [-1, 1]; higher is more relevant.
     """
     global _index, _chunks, _metadata
 
     if _index is None or corpus_size() == 0:
         return []
 
-    query_vec = embed_texts([query])  # (1, dim)
-
-    distances, indices = _index.search(query_vec, min(top_k, corpus_size()))
-    distances = distances[0]
-    indices = indices[0]
+    query_vec = embed_query(query)  # (1, dim)
+    faiss.normalize_L2(query_vec)
 
     results: List[Dict[str, Any]] = []
-    for idx, dist in zip(indices, distances):
-        if idx < 0 or idx >= len(_chunks):
-            continue
-        results.append(
-            {
-                "text": _chunks[idx],
-                "score": float(dist),
-                "source": _metadata[idx].get("source", "unknown"),
-            }
-        )
+    with _store_lock:
+        scores, indices = _index.search(query_vec, min(top_k, corpus_size()))
+        scores = scores[0]
+        indices = indices[0]
+
+        for idx, score in zip(indices, scores):
+            if idx < 0 or idx >= len(_chunks):
+                continue
+            results.append(
+                {
+                    "text": _chunks[idx],
+                    "score": float(score),
+                    "source": _metadata[idx].get("source", "unknown"),
+                }
+            )
 
     return results
@@ -0,0 +1,74 @@
+# backend_core/semantic_cache.py
+
+"""
+Semantic response cache in front of the LLM.
+
+Finished answers are stored together with the embedding of the prompt that
+produced them. When a new prompt's embedding is close enough to a cached
+one (cosine >= SIMILARITY_THRESHOLD) for the same cache key, the cached
+answer is returned instead of running a full generation.
+
+- One FAISS IndexFlatIP per cache key over L2-normalized embeddings
+  (kept separate from the RAG index)
+- Keys are chosen by the caller (e.g. mode + whether RAG is on)
+- Each key holds at most MAX_ENTRIES answers; a full key starts over
+"""
+
+import threading
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES = 1024
+
+_indexes: Dict[str, faiss.IndexFlatIP] = {}
+_answers: Dict[str, List[str]] = {}
+_lock = threading.Lock()
+
+
+def _normalized(embedding: np.ndarray) -> np.ndarray:
+    vec = np.array(embedding, dtype=np.float32).reshape(1, -1)
+    faiss.normalize_L2(vec)
+    return vec
+
+
+def lookup(embedding: np.ndarray, key: str) -> Optional[str]:
+    """
+    Return the cached answer for the most similar prompt under this key,
+    or None if nothing is similar enough.
+    """
+    vec = _normalized(embedding)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None or index.ntotal == 0:
+            return None
+        scores, indices = index.search(vec, 1)
+        score, idx = float(scores[0][0]), int(indices[0][0])
+        if idx < 0 or score < SIMILARITY_THRESHOLD:
+            return None
+        return _answers[key][idx]
+
+
+def insert(embedding: np.ndarray, key: str, answer: str) -> None:
+    """
+    Remember answer for the prompt with this embedding.
+    """
+    vec = _normalized(embedding)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None or index.ntotal >= MAX_ENTRIES:
+            index = _indexes[key] = faiss.IndexFlatIP(vec.shape[1])
+            _answers[key] = []
+        index.add(vec)
+        _answers[key].append(answer)
+
+
+def clear() -> None:
+    """
+    Drop every cached answer (e.g. after the RAG corpus changed).
+    """
+    with _lock:
+        _indexes.clear()
+        _answers.clear()
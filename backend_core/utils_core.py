@@ -5,7 +5,10 @@ Core utilities for prompt building and text streaming.
 
 This file defines:
 - get_mode_instructions(mode)
-- build_prompt(history_prompt, user_message, rag_context, mode)
+- build_prompt_prefix(mode)
+- build_history_section(history_prompt)
+- build_history_turn(user_message, answer, first_turn)
+- build_turn_prompt(user_message, rag_context, after_history)
 - sanitize_stream_text(text)
 
 The goal is to make each mode (general / coding / teacher / summarizer)
@@ -14,7 +17,7 @@ behave differently while still using the same Granite model.
 
 from __future__ import annotations
 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 
 def _format_rag_context(rag_hits: List[Dict[str, Any]], max_chars: int = 2000) -> str:
@@ -26,7 +29,8 @@ def _format_rag_context(rag_hits: List[Dict[str, Any]], max_chars: int = 2000) -
     if not rag_hits:
         return ""
 
-    lines: List[str] = []
+    # (header, text) pairs; the block text is only built once, in the final join
+    blocks: List[Tuple[str, str]] = []
     total_len = 0
 
     for i, hit in enumerate(rag_hits, start=1):
@@ -40,18 +44,18 @@ def _format_rag_context(rag_hits: List[Dict[str, Any]], max_chars: int = 2000) -
         if not text:
             continue
 
-        header = f"[{i}]"
-        if source:
-            header += f" (source: {source})"
+        header = f"[{i}] (source: {source})" if source else f"[{i}]"
+        text = text.strip()
 
-        block = f"{header}\n{text.strip()}\n"
-        if total_len + len(block) > max_chars:
+        # Same budget as the rendered "header\ntext\n" block
+        block_len = len(header) + len(text) + 2
+        if total_len + block_len > max_chars:
             break
 
-        lines.append(block)
-        total_len += len(block)
+        blocks.append((header, text))
+        total_len += block_len
 
-    return "\n".join(lines).strip()
+    return "\n\n".join(f"{header}\n{text}" for header, text in blocks)
 
 
 def get_mode_instructions(mode: str) -> str:
@@ -100,37 +104,12 @@ def get_mode_instructions(mode: str) -> str:
     )
 
 
-def build_prompt(
-    *,
-    history_prompt: str,
-    user_message: str,
-    rag_context: List[Dict[str, Any]] | None,
-    mode: str = "general",
-) -> str:
+def _render_prefix(mode: str) -> str:
     """
-    Build the final text prompt sent to the Granite model.
-
-    Parameters
-    ----------
-    history_prompt : str
-        Text version of the previous conversation (from memory_handler).
-    user_message : str
-        The new user message.
-    rag_context : list[dict] | None
-        Retrieved chunks from the vector store.
-    mode : str
-        One of: "general", "coding", "teacher", "summarizer".
-
-    Returns
-    -------
-    str
-        The full prompt string to give to the LLM.
+    System message + mode instructions for one mode.
     """
     mode_instructions = get_mode_instructions(mode)
-    rag_block = _format_rag_context(rag_context or [])
 
-    # We treat this as a "system + history + context + user" style prompt.
-    # Granite is instruction-tuned, so a clear structure works well.
     prompt_parts: List[str] = []
 
     # System / role
@@ -143,6 +122,65 @@ def build_prompt(
     prompt_parts.append("### Mode instructions\n")
     prompt_parts.append(mode_instructions.strip() + "\n")
 
+    # Trailing separator so that prefix + suffix equals the joined prompt
+    return "\n".join(prompt_parts) + "\n"
+
+
+# Static prompt prefixes, rendered once at import time
+MODES = ("general", "coding", "teacher", "summarizer")
+_MODE_PREFIX: Dict[str, str] = {m: _render_prefix(m) for m in MODES}
+
+
+def build_prompt_prefix(mode: str = "general") -> str:
+    """
+    The static start of every prompt: system message + mode instructions.
+
+    It only depends on the mode, so it is precomputed, and
+    model_loader.get_prefix_kv() can prefill it once per mode and reuse
+    the KV cache on every turn. Unknown modes get the general prefix.
+    """
+    return _MODE_PREFIX.get((mode or "general").lower(), _MODE_PREFIX["general"])
+
+
+# Conversation history goes right after the prefix and before anything that
+# only matters for the current turn (RAG snippets, the new message), so a
+# session's KV cache can cover prefix + history and be extended turn by turn.
+HISTORY_HEADER = "### Conversation so far\n\n"
+
+
+def build_history_section(history_prompt: str) -> str:
+    """
+    The history part of the prompt ("" for a new conversation).
+    history_prompt is memory_handler.format_history_for_prompt() output.
+    """
+    if not history_prompt.strip():
+        return ""
+    return HISTORY_HEADER + history_prompt.strip() + "\n"
+
+
+def build_history_turn(user_message: str, answer: str, first_turn: bool) -> str:
+    """
+    Text one finished turn adds to the history section. Appending it to
+    prefix + build_history_section(old history) gives exactly
+    prefix + build_history_section(new history).
+    """
+    turn = f"User: {user_message.strip()}\nAssistant: {answer.strip()}\n"
+    return HISTORY_HEADER + turn if first_turn else turn
+
+
+def build_turn_prompt(
+    user_message: str,
+    rag_context: List[Dict[str, Any]] | None,
+    after_history: bool,
+) -> str:
+    """
+    The per-turn end of the prompt: RAG context (if any) and the new user
+    message. after_history tells whether a history section precedes it.
+    """
+    rag_block = _format_rag_context(rag_context or [])
+
+    prompt_parts: List[str] = []
+
     # RAG context (if any)
     if rag_block:
         prompt_parts.append("### Retrieved context from user documents\n")
@@ -153,23 +191,24 @@ def build_prompt(
         )
         prompt_parts.append(rag_block + "\n")
 
-    # Conversation history
-    if history_prompt.strip():
-        prompt_parts.append("### Conversation so far\n")
-        prompt_parts.append(history_prompt.strip() + "\n")
-
     # Current user message
     prompt_parts.append("### Current user message\n")
     prompt_parts.append(f"User: {user_message.strip()}\n")
     prompt_parts.append("Assistant:")
 
-    return "\n".join(prompt_parts)
+    # Blank line between the history section and this one
+    return ("\n" if after_history else "") + "\n".join(prompt_parts)
 
 
 def sanitize_stream_text(text: str) -> str:
     """
     Light cleanup for streamed text pieces from the model.
     Removes stray control characters and normalizes newlines.
+
+    Runs once per streamed piece, so keep it cheap. Output stays plain text
+    (/chat_stream is text/plain and the UI renders it with textContent);
+    do not HTML-escape here, it would corrupt code blocks. Escaping for
+    the PDF export happens in /export_chat.
     """
     if not text:
         return ""